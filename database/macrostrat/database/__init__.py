@@ -13,6 +13,7 @@ from macrostrat.utils import get_logger
 from .mapper import DatabaseMapper
 from .postgresql import on_conflict, prefix_inserts  # noqa
 from .utils import (  # noqa
+    StatementCache,
     create_database,
     database_exists,
     drop_database,
@@ -21,6 +22,7 @@ from .utils import (  # noqa
     reflect_table,
     run_query,
     run_sql,
+    run_sql_multi,
 )
 
 metadata = MetaData()
@@ -34,12 +36,15 @@ class Database(object):
     session: Session
     __inspector__ = None
 
-    def __init__(self, db_conn, echo_sql=False, **kwargs):
+    def __init__(self, db_conn, echo_sql=False, statement_cache_size=256, **kwargs):
         """
         We can pass a connection string, a **Flask** application object
         with the appropriate configuration, or nothing, in which
         case we will try to infer the correct database from
         the SPARROW_BACKEND_CONFIG file, if available.
+
+        Parsed SQL statements are kept in an LRU cache of `statement_cache_size`
+        entries, so that repeated queries skip re-parsing.
         """
 
         compiles(Insert, "postgresql")(prefix_inserts)
@@ -55,6 +60,8 @@ class Database(object):
         self.session = scoped_session(self._session_factory)
         # Use the self.session_scope function to more explicitly manage sessions.
 
+        self._statement_cache = StatementCache(maxsize=statement_cache_size)
+
     def create_tables(self):
         """
         Create all tables described by the database's metadata instance.
@@ -97,11 +104,23 @@ class Database(object):
 
     def run_sql(self, fn, params=None, **kwargs):
         """Executes SQL files passed"""
+        kwargs.setdefault("statement_cache", self._statement_cache)
         return iter(run_sql(self.session, fn, params, **kwargs))
 
+    def run_sql_multi(self, statements):
+        """Executes several SQL statements in a single round-trip to the database"""
+        return run_sql_multi(
+            self.session, statements, statement_cache=self._statement_cache
+        )
+
     def run_query(self, sql, params=None, **kwargs):
+        kwargs.setdefault("statement_cache", self._statement_cache)
         return run_query(self.session, sql, params, **kwargs)
 
+    def run_sql_scalar(self, sql, params=None, **kwargs):
+        """Executes a single query and returns the first column of its first row"""
+        return self.run_query(sql, params, **kwargs).scalar()
+
     def exec_sql(self, sql, params=None, **kwargs):
         """Executes SQL files passed"""
         warnings.warn("exec_sql is deprecated. Use run_sql instead", DeprecationWarning)
@@ -1,17 +1,22 @@
+from collections import OrderedDict
 from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
+from re import IGNORECASE
+from re import compile as re_compile
 from re import search
 from time import sleep
 from typing import IO, Union
 from warnings import warn
 
 from click import echo, secho
-from psycopg2.extensions import set_wait_callback
+from psycopg2.extensions import encodings, set_wait_callback
 from psycopg2.extras import wait_select
 from psycopg2.sql import SQL, Composable, Composed
 from sqlalchemy import MetaData, create_engine, text
 from sqlalchemy.engine import Connection, Engine
 from sqlalchemy.exc import (
+    DBAPIError,
     IntegrityError,
     InternalError,
     InvalidRequestError,
@@ -34,35 +39,24 @@ def db_session(engine):
     return factory()
 
 
+_sql_keywords = r"\s*(SELECT|INSERT|UPDATE|CREATE|DROP|DELETE|ALTER|SET|GRANT|WITH)\s"
+_sql_text_pattern = re_compile(_sql_keywords, IGNORECASE)
+_sql_bytes_pattern = re_compile(_sql_keywords.encode("ascii"), IGNORECASE)
+
+
 def infer_is_sql_text(_string: str) -> bool:
     """
     Return True if the string is a valid SQL query,
     false if it should be interpreted as a file path.
     """
-    # If it's a byte string, decode it
     if isinstance(_string, bytes):
-        _string = _string.decode("utf-8")
-
-    keywords = [
-        "SELECT",
-        "INSERT",
-        "UPDATE",
-        "CREATE",
-        "DROP",
-        "DELETE",
-        "ALTER",
-        "SET",
-        "GRANT",
-        "WITH",
-    ]
-    lines = _string.split("\n")
-    if len(lines) > 1:
+        newline, pattern = b"\n", _sql_bytes_pattern
+    else:
+        newline, pattern = "\n", _sql_text_pattern
+    # Multi-line strings are always treated as SQL
+    if newline in _string:
         return True
-    _string = _string.lower()
-    for i in keywords:
-        if _string.strip().startswith(i.lower() + " "):
-            return True
-    return False
+    return pattern.match(_string) is not None
 
 
 def canonicalize_query(file_or_text: Union[str, Path, IO]) -> Union[str, Path]:
@@ -130,11 +124,21 @@ def get_sql_text(sql, interpret_as_file=None, echo_file_name=True):
     return sql
 
 
-def _get_queries(sql, interpret_as_file=None):
+def _split_queries(sql: str):
+    return tuple(split(format(sql, strip_comments=True)))
+
+
+def _get_queries(sql, interpret_as_file=None, statement_cache=None):
     if isinstance(sql, (list, tuple)):
         queries = []
         for i in sql:
-            queries.extend(_get_queries(i, interpret_as_file=interpret_as_file))
+            queries.extend(
+                _get_queries(
+                    i,
+                    interpret_as_file=interpret_as_file,
+                    statement_cache=statement_cache,
+                )
+            )
         return queries
     if isinstance(sql, TextClause):
         return [sql]
@@ -143,6 +147,11 @@ def _get_queries(sql, interpret_as_file=None):
 
     if sql in [None, ""]:
         return
+    if isinstance(sql, str) and not interpret_as_file:
+        # SQL text (as opposed to a file path) can be split using the cache
+        if interpret_as_file is False or infer_is_sql_text(sql):
+            cache = statement_cache or _default_statement_cache
+            return list(cache.split_queries(sql))
     if interpret_as_file:
         sql = Path(sql).read_text()
     elif interpret_as_file is None:
@@ -182,11 +191,8 @@ def _split_params(params):
     return new_params, new_bind_params
 
 
-def _get_cursor(connectable):
-    if isinstance(connectable, Engine):
-        conn = connectable.connect()
-
-    # Find a connection or cursor object for the connectable
+def _get_dbapi_connection(connectable):
+    # Find the underlying driver connection for the connectable
     conn = connectable
     if hasattr(conn, "raw_connection"):
         conn = conn.raw_connection()
@@ -197,9 +203,13 @@ def _get_cursor(connectable):
             conn = conn.connection
         if callable(conn):
             conn = conn()
+    return conn
+
+
+def _get_cursor(connectable):
+    conn = _get_dbapi_connection(connectable)
     if hasattr(conn, "cursor"):
         conn = conn.cursor()
-
     return conn
 
 
@@ -220,8 +230,8 @@ def _render_query(query: Union[SQL, Composed], connectable: Union[Engine, Connec
     """Render a query to a SQL string."""
     if not isinstance(query, (Composed, SQL)):
         return query
-    # Find a connection or cursor object for the connectable
-    conn = _get_cursor(connectable)
+    # Psycopg2 only needs a connection (not a cursor) to render the query
+    conn = _get_dbapi_connection(connectable)
     return query.as_string(conn)
 
 
@@ -229,6 +239,92 @@ def infer_has_server_binds(sql):
     return "%s" in sql or search(r"%\(\w+\)s", sql)
 
 
+_server_bind_pattern = re_compile(r"%%|%\((\w+)\)s|%s")
+
+# Statements that can be run from a server-side cursor (`DECLARE ... CURSOR FOR`)
+_streamable_pattern = re_compile(r"\(*\s*(SELECT|WITH|VALUES|TABLE)\b", IGNORECASE)
+
+
+def _prepare_server_statement(conn: Connection, query: str, maxsize=256):
+    """
+    Prepare a query with driver-native bind parameters as a server-side prepared
+    statement (once per database connection), and return an `EXECUTE` statement
+    that runs it with the same parameters. At most `maxsize` statements are kept
+    per connection; the least recently used statement is deallocated to make room.
+    If `maxsize` is 0, the query is returned unchanged.
+    """
+    if maxsize == 0:
+        return query
+    prepared = conn.info.setdefault("prepared_statements", OrderedDict())
+    if query in prepared:
+        prepared.move_to_end(query)
+    else:
+        names = []
+
+        def _replace(match):
+            if match.group(0) == "%%":
+                return "%"
+            name = match.group(1)
+            if name is None or name not in names:
+                names.append(name)
+                return f"${len(names)}"
+            return f"${names.index(name) + 1}"
+
+        body = _server_bind_pattern.sub(_replace, query)
+
+        while maxsize is not None and len(prepared) >= maxsize:
+            _, (evicted_name, _) = prepared.popitem(last=False)
+            conn.exec_driver_sql(
+                f"DEALLOCATE {evicted_name}",
+                execution_options={"no_parameters": True},
+            )
+
+        counter = conn.info.get("prepared_statement_counter", 0)
+        conn.info["prepared_statement_counter"] = counter + 1
+        statement_name = f"macrostrat_stmt_{counter}"
+        conn.exec_driver_sql(
+            f"PREPARE {statement_name} AS {body}",
+            execution_options={"no_parameters": True},
+        )
+        prepared[query] = (statement_name, names)
+
+    statement_name, names = prepared[query]
+    if len(names) == 0:
+        return f"EXECUTE {statement_name}"
+    args = ", ".join("%s" if name is None else f"%({name})s" for name in names)
+    return f"EXECUTE {statement_name} ({args})"
+
+
+def _compile_query(query: str):
+    """
+    Prepare a single SQL statement for execution, returning the query text stripped of
+    comments, whether it uses server-side bind parameters, and a SQLAlchemy `TextClause`
+    (or None if the query must be executed with the backend driver).
+    """
+    sql_text = format(query, strip_comments=True).strip()
+    has_server_binds = bool(infer_has_server_binds(sql_text))
+    clause = None
+    if not has_server_binds:
+        # Use the stripped text so that comments can't contain bind parameters
+        clause = text(sql_text)
+    return sql_text, has_server_binds, clause
+
+
+class StatementCache:
+    """
+    LRU caches of parsed SQL, keyed by query text: one for splitting SQL strings
+    into statements, and one for preparing each statement for execution.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.split_queries = lru_cache(maxsize=maxsize)(_split_queries)
+        self.compile_query = lru_cache(maxsize=maxsize)(_compile_query)
+
+
+_default_statement_cache = StatementCache()
+
+
 def _run_sql(connectable, sql, params=None, **kwargs):
     """
     Internal function for running a query on a SQLAlchemy connectable,
@@ -250,8 +346,13 @@ def _run_sql(connectable, sql, params=None, **kwargs):
         warn(DeprecationWarning("stop_on_error is deprecated, use raise_errors"))
 
     interpret_as_file = kwargs.pop("interpret_as_file", None)
+    cache = kwargs.pop("statement_cache", None) or _default_statement_cache
+    prepare_statements = kwargs.pop("prepare_statements", False)
+    stream = kwargs.pop("stream", False)
 
-    queries = _get_queries(sql, interpret_as_file=interpret_as_file)
+    queries = _get_queries(
+        sql, interpret_as_file=interpret_as_file, statement_cache=cache
+    )
 
     if queries is None:
         return
@@ -285,23 +386,38 @@ def _run_sql(connectable, sql, params=None, **kwargs):
                 query = _render_query(query, connectable)
 
             sql_text = str(query)
+            clause = query if isinstance(query, TextClause) else None
             if isinstance(query, str):
-                sql_text = format(query, strip_comments=True).strip()
+                sql_text, _has_server_binds, clause = cache.compile_query(query)
                 if sql_text == "":
                     continue
                 # Check for server-bound parameters in sql native style. If there are none, use
                 # the SQLAlchemy text() function, otherwise use the raw query string
                 if has_server_binds is None:
-                    has_server_binds = infer_has_server_binds(sql_text)
+                    has_server_binds = _has_server_binds
+
+            execution_options = {}
+            if stream and _streamable_pattern.match(sql_text):
+                # Fetch rows in batches from a server-side cursor
+                execution_options = dict(stream_results=True, max_row_buffer=1000)
 
             log.debug("Executing SQL: \n %s", query)
             if has_server_binds:
                 conn = _get_connection(connectable)
-                res = conn.exec_driver_sql(query, params)
+                if prepare_statements:
+                    query = _prepare_server_statement(conn, query, cache.maxsize)
+                    if query.startswith("EXECUTE"):
+                        # Prepared statements can't be run from a cursor
+                        execution_options = {}
+                res = conn.exec_driver_sql(
+                    query, params, execution_options=execution_options
+                )
             else:
-                if not isinstance(query, TextClause):
-                    query = text(query)
-                res = connectable.execute(query, params)
+                if clause is None:
+                    clause = text(query)
+                res = connectable.execute(
+                    clause, params, execution_options=execution_options
+                )
             yield res
             if trans is not None:
                 trans.commit()
@@ -326,11 +442,84 @@ def _run_sql(connectable, sql, params=None, **kwargs):
             set_wait_callback(None)
 
 
+def run_sql_multi(connectable, statements, statement_cache=None):
+    """
+    Run several SQL statements in a single round-trip to the database.
+
+    Parameters
+    ----------
+    connectable : Union[Engine, Connection, Session]
+        A SQLAlchemy engine, connection, or session object.
+    statements : list[tuple[str, dict]]
+        A list of `(sql, params)` pairs. Queries may use SQLAlchemy (`:name`) or
+        driver-native (`%(name)s`) bind parameters; parameters are interpolated
+        by the driver before the statements are sent as a single script.
+    statement_cache : StatementCache
+        A cache of parsed statements.
+
+    Returns the result of the final statement, or None if there are no statements
+    to run.
+    """
+    if isinstance(connectable, Engine):
+        # The result is buffered by the driver, so the connection can be released
+        with connectable.connect() as conn:
+            return run_sql_multi(conn, statements, statement_cache=statement_cache)
+    cache = statement_cache or _default_statement_cache
+
+    compiled = []
+    for sql, params in statements:
+        sql_text, has_server_binds, clause = cache.compile_query(sql)
+        if sql_text != "":
+            compiled.append((sql_text, has_server_binds, clause, params))
+    if len(compiled) == 0:
+        return None
+
+    try:
+        trans = connectable.begin()
+    except InvalidRequestError:
+        trans = None
+
+    conn = _get_connection(connectable)
+    cursor = _get_cursor(conn)
+    encoding = encodings[cursor.connection.encoding]
+
+    queries = []
+    for sql_text, has_server_binds, clause, params in compiled:
+        if params:
+            if not has_server_binds:
+                # Render SQLAlchemy bind parameters in the driver's style
+                sql_text = str(clause.compile(dialect=conn.dialect))
+            sql_text = cursor.mogrify(sql_text, params).decode(encoding)
+        queries.append(sql_text.rstrip(";"))
+    cursor.close()
+
+    script = ";\n".join(queries)
+    log.debug("Executing SQL: \n %s", script)
+    try:
+        # Parameters are already interpolated, so percent signs must be passed through as-is
+        res = conn.exec_driver_sql(script, execution_options={"no_parameters": True})
+    except DBAPIError as err:
+        if trans is not None:
+            trans.rollback()
+        elif hasattr(connectable, "rollback"):
+            connectable.rollback()
+        log.error(err)
+        raise err
+    if trans is not None:
+        trans.commit()
+    elif hasattr(connectable, "commit"):
+        connectable.commit()
+    return res
+
+
 def run_sql_file(connectable, filename, params=None, **kwargs):
     return run_sql(connectable, filename, params, interpret_as_file=True, **kwargs)
 
 
 def run_query(connectable, query, params=None, **kwargs):
+    if kwargs.get("stream", False) and isinstance(connectable, Engine):
+        # The engine's connection would be closed before any rows are fetched
+        raise ValueError("stream requires a connection or session in run_query")
     return next(
         iter(
             _run_sql(
@@ -375,9 +564,27 @@ def run_sql(*args, **kwargs):
         returning a list after completion.
     ensure_single_query : bool
         If True, raise an error if multiple queries are passed when only one is expected.
+    statement_cache : StatementCache
+        A cache of parsed statements. By default, a module-level cache of 256
+        statements is used.
+    prepare_statements : bool
+        If True, queries with server-side bind parameters are run as PostgreSQL
+        prepared statements, which are created once per database connection so that
+        repeated queries skip parsing and planning. Each connection keeps as many
+        prepared statements as the statement cache holds, deallocating the least
+        recently used; a cache size of 0 disables them. Only statements supported
+        by `PREPARE` (e.g., SELECT, INSERT, UPDATE, DELETE) can be prepared.
+    stream : bool
+        If True, fetch rows in batches from a server-side cursor rather than
+        loading each result into memory at once. This implies `yield_results`;
+        each result should be consumed before moving on to the next query, since
+        its cursor is closed when the transaction is committed. Only statements
+        beginning with SELECT, WITH, VALUES or TABLE are streamed; other
+        statements in the same script, as well as prepared statements, are run
+        normally. A WITH statement that modifies data cannot be streamed.
     """
     res = _run_sql(*args, **kwargs)
-    if kwargs.pop("yield_results", False):
+    if kwargs.pop("yield_results", False) or kwargs.get("stream", False):
         return res
     return list(res)
 
@@ -436,12 +643,22 @@ def get_db_model(db, model_name: str):
 
 
 @contextmanager
-def temp_database(conn_string, drop=True, ensure_empty=False):
-    """Create a temporary database and tear it down after tests."""
-    create_database(conn_string, exists_ok=True, replace=ensure_empty)
+def temp_database(conn_string, drop=True, ensure_empty=False, template=None, **kwargs):
+    """Create a temporary database and tear it down after tests.
+
+    If a `template` database name is given, the new database is created as a
+    copy of it, which is much faster than re-running schema scripts.
+    Additional keyword arguments (e.g., connection pool settings) are passed
+    to `sqlalchemy.create_engine`.
+    """
+    create_database(
+        conn_string, exists_ok=True, replace=ensure_empty, template=template
+    )
+    engine = create_engine(conn_string, **kwargs)
     try:
-        yield create_engine(conn_string)
+        yield engine
     finally:
+        engine.dispose()
         if drop:
             drop_database(conn_string)
 
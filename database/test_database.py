@@ -4,59 +4,209 @@ Test the database module.
 NOTE: At the moment, these tests are not independent and must run in order.
 """
 
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from hashlib import sha1
+from os import environ
 from pathlib import Path
 from sys import stdout
 
 from dotenv import load_dotenv
 from psycopg2.errors import SyntaxError
-from psycopg2.extensions import AsIs
+from psycopg2.extensions import AsIs, QueryCanceledError
 from psycopg2.sql import SQL, Identifier, Literal, Placeholder
 from pytest import fixture, mark, raises, warns
-from sqlalchemy.exc import ProgrammingError
+from sqlalchemy import create_engine, make_url
+from sqlalchemy.exc import DataError, DBAPIError, OperationalError, ProgrammingError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool, QueuePool
 from sqlalchemy.sql import text
 
-from macrostrat.database import Database, run_sql
+from macrostrat.database import (
+    Database,
+    StatementCache,
+    run_query,
+    run_sql,
+    run_sql_multi,
+)
 from macrostrat.database.postgresql import table_exists
-from macrostrat.database.utils import infer_is_sql_text, temp_database
+from macrostrat.database.utils import (
+    database_exists,
+    drop_database,
+    infer_is_sql_text,
+    temp_database,
+)
 from macrostrat.utils import get_logger, relative_path
 
 load_dotenv()
 
 log = get_logger(__name__)
 
+insert_sample_query = "INSERT INTO sample (name) VALUES (:name)"
 
-@fixture(scope="session")
-def engine(database_url, pytestconfig):
-    with temp_database(database_url, drop=pytestconfig.option.teardown) as engine:
-        yield engine
+seed_sample_query = """
+INSERT INTO sample (name)
+SELECT 'Test' WHERE NOT EXISTS (SELECT 1 FROM sample WHERE name = 'Test')
+"""
 
+list_databases_query = "SELECT datname FROM pg_database"
 
-@fixture(scope="session")
-def empty_db(engine):
-    return Database(engine.url)
+# An arbitrary key for the advisory lock guarding test database setup
+setup_lock_key = 8316
 
+# Connection pool settings for the test database. The pool class and sizes are
+# SQLAlchemy's defaults for psycopg2, stated explicitly; pre-pinging and recycling
+# connections replace stale sockets rather than failing the test that checks one out.
+pool_options = dict(
+    poolclass=QueuePool,
+    pool_size=5,
+    max_overflow=10,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+)
 
-@fixture(scope="session")
-def db(empty_db):
-    # Get schema files
-    schema_files = Path(relative_path(__file__, "test-fixtures")).glob("*.sql")
 
-    file_list = list(schema_files)
+def get_schema_files():
+    schema_files = Path(relative_path(__file__, "test-fixtures")).glob("*.sql")
+    file_list = sorted(schema_files)
     assert len(file_list) == 1
+    return file_list
+
 
+def schema_digest(file_list):
+    """A short hash of the schema files, used to rebuild the template when they change."""
+    digest = sha1()
+    for sqlfile in file_list:
+        digest.update(sqlfile.name.encode("utf-8"))
+        digest.update(sqlfile.read_bytes())
+    return digest.hexdigest()[:12]
+
+
+def create_schema(engine, file_list):
     # Create tables
     for sqlfile in file_list:
-        res = run_sql(empty_db.engine, sqlfile)
+        res = run_sql(engine, sqlfile)
         assert len(res) == 3
+
+
+@contextmanager
+def setup_lock(url):
+    """Hold a PostgreSQL advisory lock to serialize database setup across test workers."""
+    engine = create_engine(url, poolclass=NullPool)
+    try:
+        with engine.connect() as conn:
+            conn.execute(
+                text("SELECT pg_advisory_lock(:key)"), dict(key=setup_lock_key)
+            )
+            try:
+                yield conn
+            finally:
+                conn.execute(
+                    text("SELECT pg_advisory_unlock(:key)"), dict(key=setup_lock_key)
+                )
+    finally:
+        engine.dispose()
+
+
+@fixture(scope="session")
+def template_url(database_url, pytestconfig):
+    """
+    A template database holding the test schema. It is created once for each
+    version of the schema files and cloned for each test worker, which skips
+    replaying the schema scripts.
+    """
+    file_list = get_schema_files()
+    url = make_url(database_url)
+    prefix = f"{url.database}_template_"
+    url = url.set(database=prefix + schema_digest(file_list))
+    with setup_lock(database_url) as conn:
+        if not database_exists(url):
+            # Remove templates built from previous versions of the schema
+            for name in conn.execute(text(list_databases_query)).scalars():
+                if name.startswith(prefix):
+                    drop_database(url.set(database=name))
+            with temp_database(url, drop=False) as engine:
+                create_schema(engine, file_list)
+    yield url
+    if pytestconfig.option.teardown:
+        with setup_lock(database_url):
+            if database_exists(url):
+                drop_database(url)
+
+
+@fixture(scope="session")
+def engine(database_url, template_url, pytestconfig):
+    # A separate database for each pytest-xdist worker (if running in parallel)
+    worker_id = environ.get("PYTEST_XDIST_WORKER", "main")
+    url = make_url(database_url)
+    url = url.set(database=f"{url.database}_{worker_id}")
+    with temp_database(
+        url,
+        drop=pytestconfig.option.teardown,
+        ensure_empty=True,
+        template=template_url.database,
+        **pool_options,
+    ) as engine:
+        yield engine
+
+
+@fixture(scope="session")
+def empty_db(engine):
+    db = Database(engine.url, **pool_options)
+    yield db
+    db.engine.dispose()
+
+
+@fixture(scope="module")
+def db(empty_db):
+    # Seed the sample row that tests query against. This is committed once for
+    # the module, so it is also visible to tests that bypass the session.
+    run_sql(empty_db.engine, seed_sample_query, raise_errors=True)
     return empty_db
 
 
+@fixture(autouse=True)
+def transaction(request):
+    """
+    Run each database test inside an outer transaction that is rolled back at teardown.
+    The session joins this transaction using a savepoint, so commits within
+    the test only release the savepoint and nothing is written to the database.
+    https://docs.sqlalchemy.org/en/20/orm/session_transaction.html#joining-a-session-into-an-external-transaction-such-as-for-test-suites
+    """
+    if "db" not in request.fixturenames:
+        yield
+        return
+    db = request.getfixturevalue("db")
+
+    connection = db.engine.connect()
+    trans = connection.begin()
+    session = Session(bind=connection, join_transaction_mode="create_savepoint")
+
+    _session = db.session
+    db.session = session
+    try:
+        yield session
+    finally:
+        db.session = _session
+        session.close()
+        trans.rollback()
+        connection.close()
+
+
+@fixture(scope="module")
+def format_context(db):
+    """A driver connection used only to render psycopg2 SQL objects to strings."""
+    conn = db.engine.raw_connection()
+    yield conn.driver_connection
+    conn.close()
+
+
 @fixture(scope="function")
 def conn(db):
     """A connection managed by the database session."""
-    connection = db.session.connection()
-    yield connection
-    db.session.rollback()
+    return db.session.connection()
 
 
 def test_database(db):
@@ -79,40 +229,95 @@ def test_database_mapper(db):
     assert isinstance(s._formation, Formation)
 
 
-def test_sql_text_inference():
-    assert infer_is_sql_text("SELECT * FROM sample")
-
-
-def test_sql_text_inference_2():
-    assert infer_is_sql_text(b"SELECT * FROM sample")
+@mark.parametrize(
+    "sql,expected",
+    [
+        ("SELECT * FROM sample", True),
+        (b"SELECT * FROM sample", True),
+        ("sample.sql", False),
+        ("select.sql", False),
+        ("SELECT.sql", False),
+        (insert_sample_query, True),
+    ],
+)
+def test_sql_text_inference(sql, expected):
+    assert infer_is_sql_text(sql) == expected
 
 
-def test_sql_text_inference_3():
-    assert not infer_is_sql_text("sample.sql")
-
-
-def test_sql_text_inference_4():
-    assert not infer_is_sql_text("select.sql")
-
-
-def test_sql_text_inference_5():
-    assert not infer_is_sql_text("SELECT.sql")
-
+def test_sql_interpolation_psycopg(db):
+    sql1 = "SELECT * FROM sample WHERE name = :name"
+    res = db.run_sql_multi(
+        [
+            (insert_sample_query, dict(name="Test")),
+            (sql1, dict(name="Test")),
+        ]
+    )
+    assert res.first().name == "Test"
 
-insert_sample_query = "INSERT INTO sample (name) VALUES (:name)"
 
+def test_run_sql_multi_server_binds(db):
+    sql = "SELECT name FROM sample WHERE name = %(name)s AND '%%' = '%%'"
+    res = db.run_sql_multi(
+        [
+            ("INSERT INTO sample (name) VALUES (%(name)s)", dict(name="Test 50%")),
+            (sql, dict(name="Test 50%")),
+        ]
+    )
+    assert res.scalar() == "Test 50%"
 
-def test_sql_text_inference_6():
-    assert infer_is_sql_text(insert_sample_query)
 
+def test_run_sql_multi_comments(db):
+    """Comments should not swallow statement separators or be scanned for bind parameters."""
+    res = db.run_sql_multi(
+        [
+            ("SELECT :a AS x -- trailing comment", dict(a=1)),
+            (
+                "/* :not_a_param */ SELECT name FROM sample WHERE name = :name",
+                dict(name="Test"),
+            ),
+        ]
+    )
+    assert res.scalar() == "Test"
 
-def test_sql_interpolation_psycopg(db):
-    db.run_sql(insert_sample_query, params=dict(name="Test"), raise_errors=True)
-    db.session.commit()
 
-    sql1 = "SELECT * FROM sample WHERE name = :name"
-    res = list(db.run_sql(sql1, params=dict(name="Test"), raise_errors=True))[0]
-    assert res.first().name == "Test"
+def test_run_sql_multi_engine(db):
+    """Connections checked out for an engine should be returned to the pool."""
+    engine = create_engine(db.engine.url, pool_size=1, max_overflow=0, pool_timeout=1)
+    try:
+        res1 = run_sql_multi(engine, [("SELECT 1", None)])
+        res2 = run_sql_multi(engine, [("SELECT 2", None)])
+        assert res1.scalar() == 1
+        assert res2.scalar() == 2
+    finally:
+        engine.dispose()
+
+
+def test_run_sql_multi_error(db):
+    """A failed script should not leave the session's transaction aborted."""
+    with raises(DataError):
+        db.run_sql_multi([("SELECT 1/0", None)])
+    assert db.run_sql_scalar("SELECT 1") == 1
+
+
+@mark.parametrize("statements", [[], [("-- only a comment", None)]])
+def test_run_sql_multi_empty(db, statements):
+    """An empty script should not be sent or leave a transaction open."""
+    with db.engine.connect() as conn:
+        assert run_sql_multi(conn, statements) is None
+        assert not conn.in_transaction()
+
+
+def test_statement_cache(db):
+    sql = "SELECT name FROM sample WHERE name = :name"
+    db.run_query(sql, dict(name="Test"))
+    cache = db._statement_cache
+    split_hits = cache.split_queries.cache_info().hits
+    compile_hits = cache.compile_query.cache_info().hits
+    res = db.run_query(sql, dict(name="Test"))
+    assert res.scalar() == "Test"
+    # Neither splitting nor preparing the statement is repeated
+    assert cache.split_queries.cache_info().hits == split_hits + 1
+    assert cache.compile_query.cache_info().hits == compile_hits + 1
 
 
 def test_extraneous_argument(db):
@@ -120,36 +325,32 @@ def test_extraneous_argument(db):
     db.run_sql(insert_sample_query, params=dict(name="Test2", extraneous="TestA"))
 
 
-def test_sql_identifier(db):
+def test_sql_identifier(db, format_context):
     sql = (
         SQL("SELECT name FROM {table} WHERE name = {name}")
         .format(table=Identifier("sample"), name=Literal("Test"))
-        .as_string(db.engine.raw_connection().cursor())
+        .as_string(format_context)
     )
     assert infer_is_sql_text(sql)
-    res = list(db.run_sql(sql, raise_errors=True))
-    assert len(res) == 1
-    assert res[0].scalar() == "Test"
+    assert db.run_sql_scalar(sql) == "Test"
 
 
-def test_raises_deprecation(db):
+def test_raises_deprecation(db, format_context):
     sql = (
         SQL("SELECT name FROM {table} WHERE name = {name}")
         .format(table=Identifier("sample"), name=Literal("Test"))
-        .as_string(db.engine.raw_connection().cursor())
+        .as_string(format_context)
     )
     with warns(DeprecationWarning):
         db.run_sql(sql, stop_on_error=True)
 
 
-def test_partial_identifier(db):
+def test_partial_identifier(db, format_context):
     """https://www.postgresql.org/docs/current/sql-prepare.html"""
-    conn = db.engine.raw_connection()
-    cursor = conn.cursor()
     sql = (
         SQL("SELECT name FROM sam{partial_table} WHERE name = {name}")
         .format(name=Placeholder("name"), partial_table=SQL("ple"))
-        .as_string(cursor)
+        .as_string(format_context)
     )
 
     with db.engine.begin() as conn:
@@ -180,9 +381,7 @@ def test_sql_object(db):
     sql = SQL("SELECT name FROM {table} WHERE name = {name}")
     params = dict(table=Identifier("sample"), name=Literal("Test"))
 
-    res = list(db.run_sql(sql, raise_errors=True, params=params))
-    assert len(res) == 1
-    assert res[0].scalar() == "Test"
+    assert db.run_sql_scalar(sql, params) == "Test"
 
 
 def test_sqlalchemy_bound_parameters(db):
@@ -196,9 +395,54 @@ def test_server_bound_parameters(db):
     """If we have Postgres-style string bind parameters, make sure we don't try to bind SQLAlchemy parameters."""
     sql = "SELECT name FROM sample WHERE name = %(name)s"
     params = dict(name="Test")
-    res = list(db.run_sql(sql, params=params, raise_errors=True))
-    assert len(res) == 1
-    assert res[0].scalar() == "Test"
+    assert db.run_sql_scalar(sql, params) == "Test"
+
+
+def test_server_prepared_statement(db):
+    sql = "SELECT name FROM sample WHERE name = %(name)s AND name = %(name)s"
+    for _ in range(2):
+        res = db.run_query(sql, dict(name="Test"), prepare_statements=True)
+        assert res.scalar() == "Test"
+    # The statement should only have been prepared once for the connection
+    names = db.run_query(
+        "SELECT name FROM pg_prepared_statements WHERE statement LIKE :pattern",
+        dict(pattern="%WHERE name = $1 AND name = $1"),
+    ).scalars()
+    assert [n.startswith("macrostrat_stmt_") for n in names] == [True]
+
+
+def test_server_prepared_statement_eviction(db):
+    cache = StatementCache(maxsize=2)
+    sql = "SELECT name FROM sample WHERE name = %(name)s AND {} = {}"
+    for i in range(3):
+        res = db.run_query(
+            sql.format(i, i),
+            dict(name="Test"),
+            prepare_statements=True,
+            statement_cache=cache,
+        )
+        assert res.scalar() == "Test"
+    # The least recently used statement should have been deallocated
+    prepared = db.run_query(
+        "SELECT statement FROM pg_prepared_statements WHERE statement LIKE :pattern",
+        dict(pattern="%WHERE name = $1 AND _ = _"),
+    ).scalars()
+    assert sorted(s.split("AND ")[-1] for s in prepared) == ["1 = 1", "2 = 2"]
+
+
+def test_server_prepared_statement_cache_disabled(db):
+    """A zero-size statement cache runs queries without preparing them."""
+    cache = StatementCache(maxsize=0)
+    sql = "SELECT name FROM sample WHERE name = %(name)s AND 'disabled' = 'disabled'"
+    res = db.run_query(
+        sql, dict(name="Test"), prepare_statements=True, statement_cache=cache
+    )
+    assert res.scalar() == "Test"
+    n_prepared = db.run_sql_scalar(
+        "SELECT count(*) FROM pg_prepared_statements WHERE statement LIKE :pattern",
+        dict(pattern="%'disabled' = 'disabled'"),
+    )
+    assert n_prepared == 0
 
 
 def test_server_bound_parameters_mixed(db):
@@ -257,11 +501,48 @@ def test_server_parameters_function_def(db):
     db.run_sql(sql, raise_errors=True, has_server_binds=False)
 
 
+@mark.slow
 def test_long_running_sql(db):
     sql = "SELECT pg_sleep(0.5)"
-    res = list(db.run_sql(sql, raise_errors=True))
-    assert len(res) == 1
-    assert res[0].scalar() == ""
+    results = db.run_sql(sql, raise_errors=True, stream=True)
+    res = next(results)
+    # Rows are fetched from a named (server-side) cursor
+    assert res.cursor.name is not None
+    assert res.scalar() == ""
+    assert len(list(results)) == 0
+
+
+def test_stream_mixed_script(db):
+    """Only row-returning statements should be run from a server-side cursor."""
+    sql = """
+    CREATE TEMP TABLE stream_test (id serial, name text);
+    INSERT INTO stream_test (name) VALUES ('a'), ('b') RETURNING id;
+    SELECT name FROM stream_test ORDER BY id;
+    """
+    results = db.run_sql(sql, raise_errors=True, stream=True)
+    res = next(results)
+    assert not res.returns_rows
+    res = next(results)
+    assert res.cursor.name is None
+    assert res.scalars().all() == [1, 2]
+    res = next(results)
+    assert res.cursor.name is not None
+    assert res.scalars().all() == ["a", "b"]
+    assert len(list(results)) == 0
+
+
+def test_stream_engine(db):
+    results = run_sql(db.engine, "SELECT generate_series(1, 5)", stream=True)
+    assert [r.scalars().all() for r in results] == [[1, 2, 3, 4, 5]]
+    # The engine's connection is closed once run_query returns
+    with raises(ValueError):
+        run_query(db.engine, "SELECT generate_series(1, 5)", stream=True)
+
+
+def test_stream_prepared_statement(db):
+    sql = "SELECT name FROM sample WHERE name = %(name)s AND 'stream' = 'stream'"
+    results = db.run_sql(sql, dict(name="Test"), stream=True, prepare_statements=True)
+    assert [r.scalar() for r in results] == ["Test"]
 
 
 def test_run_query(db):
@@ -296,17 +577,12 @@ def test_copy_statement(db):
     cur.copy_expert("COPY sample (name) TO STDOUT", stdout)
 
 
+@mark.slow
 def test_close_connection(conn):
     """
     Basic test demonstrating the underlying capability to kill a long-running query
     by closing the connection to the database.
     """
-
-    import threading
-
-    from psycopg2.extensions import QueryCanceledError
-    from sqlalchemy.exc import DBAPIError
-
     sql = text("SELECT pg_sleep(10)")
 
     seconds = 1
@@ -323,36 +599,42 @@ def test_close_connection(conn):
     t.cancel()
 
 
+def run_long_running_query(db):
+    """Run a long-running query, returning True if it was canceled by the user."""
+    try:
+        db.run_sql("SELECT pg_sleep(10);")
+    except OperationalError as e:
+        if "canceling statement due to user request" in str(e):
+            return True
+    return False
+
+
+@mark.slow
 def test_sigint_cancel(db):
     """
     Basic test demonstrating the underlying capability to kill a long-running query
     by sending a SIGINT.
     """
+    interrupted = []
 
-    import signal
-    import subprocess
-    import time
+    def send_interrupt():
+        interrupted.append(time.time())
+        # Signal the main thread directly so that its wait on the query is interrupted
+        signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
 
-    db_url = str(db.engine.url)
-
-    # Time how long it takes to run the script
+    # Time how long it takes to run the query
     start = time.time()
 
-    script = relative_path(__file__, "test-scripts/test-long-running-query")
+    t = threading.Timer(0.25, send_interrupt)
+    t.start()
+    try:
+        assert run_long_running_query(db)
+    finally:
+        t.cancel()
 
-    p = subprocess.Popen(
-        [
-            str(script),
-            db_url,
-        ],
-    )
-    time.sleep(0.5)
-    p.send_signal(signal.SIGINT)
-    p.wait()
-    assert p.returncode == 1
-    # Make sure it didn't take too long
-    dT = time.time() - start
-    assert dT < 2
+    # Make sure the query was canceled promptly
+    assert time.time() - interrupted[0] < 0.1
+    assert time.time() - start < 2
 
 
 def test_check_table_exists(db):